@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+# Offline benchmark for pos2cmine.py
+#
+# Starts a local stand-in for PoS and CMINE and measures full and
+# incremental syncs against it. No real PoS or CMINE is contacted.
+
+import os
+import sys
+import json
+import re
+import time
+import random
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+import collections
+import tracemalloc
+import urllib.parse
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from dateutil import tz
+
+import pos2cmine
+
+
+class MockServer (ThreadingHTTPServer):
+    """Stand-in for PoS group_export and the CMINE (Hivebrite) admin API"""
+
+    daemon_threads = True
+
+    def __init__ (self, port, solutions, others=100, latency=0.0, error_rate=0.0, rate_limit=None, page_size=10):
+        ThreadingHTTPServer.__init__ (self, ("127.0.0.1", port), MockHandler)
+        self.base = "http://127.0.0.1:{}".format (port)
+        self.latency = latency
+        self.errorRate = error_rate
+        self.rateLimit = rate_limit
+        self.pageSize = page_size
+        self.lock = threading.Lock ()
+        self.counts = collections.Counter ()
+        self.window = (0, 0)
+        self.tokens = set ()
+        self.ids = itertools.count (1)
+        self.solutions = [self.solution (i, "2019-09-10T17:07:26+0200") for i in range (solutions)]
+        self.ventures = collections.OrderedDict ()
+        # ventures of other users in the network
+        for i in range (others):
+            vid = next (self.ids)
+            self.ventures[vid] = {"id": vid, "user_id": 1000 + i % 7, "high_level_pitch": "Other venture {}".format (i),
+                                  "updated_at": "2019-01-01T00:00:00Z"}
+
+    def solution (self, i, changed, revision=0):
+        return {
+            "id": str (i),
+            "language": "English",
+            "langcode": "en",
+            "base_url": self.base,
+            "title": "Solution {} &#039;{}&#039;".format (i, i % 97),
+            "group_uri": "/en/group/{}".format (i),
+            "type": "Solution",
+            "provider": "Provider {}".format (i % 13),
+            "summary_short": "Short summary of solution {}".format (i),
+            "summary": "<p>Summary of solution {} revision {}.</p>\n".format (i, revision) * 20,
+            "innovation_stage": "Stage 4: Early Adoption/ Distribution",
+            "trl": "TRL {} - System prototype".format (1 + i % 9),
+            "illustration_uri": "/sites/default/files/{}.png".format (i),
+            "video_url": "",
+            "changed": changed,
+        }
+
+    def touch (self, fraction):
+        """Change a fraction of the PoS solutions now"""
+        now = datetime.datetime.now (tz.tzutc ()).strftime ("%Y-%m-%dT%H:%M:%S%z")
+        with self.lock:
+            n = int (len (self.solutions) * fraction)
+            for i in random.sample (range (len (self.solutions)), n):
+                self.solutions[i] = self.solution (i, now, revision=1)
+        return n
+
+    def allow (self):
+        """Rate limit window of one second; returns (allowed, headers)"""
+        if self.rateLimit is None:
+            return True, []
+        with self.lock:
+            second = int (time.time ())
+            start, used = self.window
+            if start != second:
+                start, used = second, 0
+            used += 1
+            self.window = (start, used)
+        remaining = max (0, self.rateLimit - used)
+        headers = [("X-RateLimit-Limit", str (self.rateLimit)), ("X-RateLimit-Remaining", str (remaining)), ("X-RateLimit-Reset", "1")]
+        if used > self.rateLimit:
+            return False, headers + [("Retry-After", "1")]
+        return True, headers
+
+
+class MockHandler (BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately; avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message (self, format, *args):
+        pass
+
+    def send (self, status, data=None, headers=()):
+        body = json.dumps (data).encode ("utf-8") if data is not None else b""
+        self.send_response (status)
+        self.send_header ("Content-Type", "application/json")
+        self.send_header ("Content-Length", str (len (body)))
+        for k, v in headers:
+            self.send_header (k, v)
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def do_GET (self):
+        self.handle_request ("GET")
+
+    def do_POST (self):
+        self.handle_request ("POST")
+
+    def do_PUT (self):
+        self.handle_request ("PUT")
+
+    def do_DELETE (self):
+        self.handle_request ("DELETE")
+
+    def handle_request (self, method):
+        server = self.server
+        length = int (self.headers.get ("Content-Length") or 0)
+        body = json.loads (self.rfile.read (length)) if length else {}
+        url = urllib.parse.urlsplit (self.path)
+        query = dict (urllib.parse.parse_qsl (url.query))
+        path = url.path
+        if path == "/_stats":
+            with server.lock:
+                counts = dict (server.counts)
+                if "reset" in query:
+                    server.counts.clear ()
+            return self.send (200, counts)
+        if path == "/_touch":
+            return self.send (200, {"touched": server.touch (float (query.get ("fraction", 0.01)))})
+
+        endpoint = "{} {}".format (method, re.sub (r"/\d+", "/{id}", path))
+        with server.lock:
+            server.counts[endpoint] += 1
+        if server.latency:
+            time.sleep (server.latency)
+
+        if path == "/en/group_export":
+            return self.groupExport (query)
+
+        if path == "/oauth/token":
+            token = "token-{}".format (random.getrandbits (64))
+            with server.lock:
+                server.tokens.add (token)
+            return self.send (200, {"access_token": token, "token_type": "Bearer", "expires_in": 7200, "created_at": int (time.time ())})
+
+        if not path.startswith ("/api/"):
+            return self.send (404, {"error": "not found"})
+        allowed, headers = server.allow ()
+        if not allowed:
+            return self.send (429, {"error": "rate limit exceeded"}, headers)
+        if random.random () < server.errorRate:
+            return self.send (503, {"error": "service unavailable"}, headers)
+        if self.headers.get ("Authorization", "")[len ("Bearer "):] not in server.tokens:
+            return self.send (401, {"error": "invalid token"}, headers)
+
+        if path == "/api/admin/v1/me":
+            return self.send (200, {"admin": {"id": 1}}, headers)
+        if path == "/api/admin/v1/users":
+            return self.users (query, headers)
+        if path == "/api/admin/v1/settings/customizable_attributes":
+            return self.send (200, {"customizable_attributes": [
+                {"name": "_2e743dbd_Technology_Readiness_Level__TRL_", "display_name": "Technology Readiness Level (TRL)"},
+                {"name": "_b1c2_Country", "display_name": "Country"}]}, headers)
+        m = re.match (r"^/api/admin/v2/ventures(?:/(\d+))?$", path)
+        if m:
+            return self.ventures (method, int (m.group (1)) if m.group (1) else None, query, body, headers)
+        return self.send (404, {"error": "not found"}, headers)
+
+    def groupExport (self, query):
+        server = self.server
+        offset = int (query.get ("offset", 0))
+        with server.lock:
+            solutions = server.solutions
+            if "changed" in query:
+                # PoS understands relative times like "-90 minutes"
+                m = re.match (r"^-(\d+) (minute|hour|day|week|month)s?$", query["changed"])
+                if m is None:
+                    return self.send (400, {"error": "bad changed filter"})
+                unit = {"minute": 60, "hour": 3600, "day": 86400, "week": 604800, "month": 2592000}[m.group (2)]
+                since = time.time () - int (m.group (1)) * unit
+                solutions = [s for s in solutions if pos2cmine.iso8601.parse_date (s["changed"]).timestamp () >= since]
+            page = solutions[offset:offset + server.pageSize]
+        return self.send (200, page)
+
+    def users (self, query, headers):
+        # 250 users, the owner not on the first page; no email filter
+        page = int (query.get ("page", 1))
+        perPage = min (int (query.get ("per_page", 25)), 100)
+        users = [{"id": 1000 + i, "email": "user{}@example.org".format (i)} for i in range (250)]
+        users[130] = {"id": 42, "email": "owner@example.org"}
+        links = []
+        if page * perPage < len (users):
+            links.append ('<{}/api/admin/v1/users?page={}&per_page={}>; rel="next"'.format (self.server.base, page + 1, perPage))
+        return self.send (200, {"users": users[(page - 1) * perPage:page * perPage]}, headers + [("Link", ", ".join (links))])
+
+    def ventures (self, method, vid, query, body, headers):
+        server = self.server
+        now = datetime.datetime.now (tz.tzutc ()).strftime ("%Y-%m-%dT%H:%M:%SZ")
+        with server.lock:
+            if vid is None and method == "GET":
+                page = int (query.get ("page", 1))
+                perPage = min (int (query.get ("per_page", 25)), 100)
+                ventures = list (server.ventures.values ())
+                last = max (1, (len (ventures) + perPage - 1) // perPage)
+                links = []
+                if page < last:
+                    links.append ('<{}/api/admin/v2/ventures?page={}&per_page={}>; rel="next"'.format (server.base, page + 1, perPage))
+                links.append ('<{}/api/admin/v2/ventures?page={}&per_page={}>; rel="last"'.format (server.base, last, perPage))
+                data = {"ventures": ventures[(page - 1) * perPage:page * perPage]}
+                return self.send (200, data, headers + [("Link", ", ".join (links)), ("X-Total", str (len (ventures))), ("X-Per-Page", str (perPage))])
+            if vid is None and method == "POST":
+                venture = dict (body["venture"], id=next (server.ids), updated_at=now)
+                server.ventures[venture["id"]] = venture
+                return self.send (201, {"venture": venture}, headers)
+            if vid not in server.ventures:
+                return self.send (404, {"error": "venture not found"}, headers)
+            if method == "GET":
+                return self.send (200, {"venture": server.ventures[vid]}, headers)
+            if method == "PUT":
+                server.ventures[vid].update (body["venture"], updated_at=now)
+                return self.send (200, {"venture": server.ventures[vid]}, headers)
+            if method == "DELETE":
+                del server.ventures[vid]
+                return self.send (204, None, headers)
+        return self.send (405, {"error": "method not allowed"}, headers)
+
+
+def startServer (args, solutions, port):
+    """Run the mock server in its own process so it does not share our GIL"""
+    cmd = [sys.executable, os.path.abspath (__file__), "--serve", "--port", str (port), "--solutions", str (solutions),
+           "--others", str (args.others), "--latency", str (args.latency), "--error-rate", str (args.error_rate),
+           "--pos-page-size", str (args.pos_page_size)]
+    if args.rate_limit:
+        cmd += ["--rate-limit", str (args.rate_limit)]
+    server = subprocess.Popen (cmd, stdout=subprocess.PIPE)
+    # the server reports when it is listening, e.g. not if the port is in use
+    if server.stdout.readline ().strip () != b"ready":
+        server.kill ()
+        raise Exception ("Mock server did not start on port {}".format (port))
+    return server, "http://127.0.0.1:{}".format (port)
+
+
+def runSync (args, url, indexFile, changed=None):
+    """One sync against the mock server, returns measurements"""
+    requests.get (url + "/_stats?reset=1")
+    pos2cmine.client = pos2cmine.HttpClient (max (10, args.workers, args.pos_parallel, args.cmine_parallel), retries=args.retries)
+    pos2cmine.metrics = pos2cmine.Metrics ()
+    tokens = pos2cmine.TokenManager (url, "admin@example.org", "secret", "uid", "secret")
+    index = pos2cmine.VentureIndex (indexFile)
+    target = pos2cmine.CmineTarget (url, tokens, "owner@example.org", index, args.cmine_parallel, args.cmine_per_page,
+                                     metadata_ttl=args.metadata_ttl * 3600)
+    # syncToCmine counts into the metrics itself
+    summary = collections.Counter ()
+    if args.memory:
+        tracemalloc.start ()
+    start = time.perf_counter ()
+    solutions = pos2cmine.posGenerator (url, args.pos_prefetch, args.pos_parallel, changed)
+    errors = pos2cmine.syncToCmine (solutions, target, args.workers, summary, queue_size=args.queue_size)
+    wall = time.perf_counter () - start
+    peak = None
+    if args.memory:
+        peak = tracemalloc.get_traced_memory ()[1]
+        tracemalloc.stop ()
+    index.close ()
+    counts = requests.get (url + "/_stats").json ()
+    total = sum (counts.values ())
+    return {
+        "wall_s": round (wall, 3),
+        "requests": total,
+        "requests_per_s": round (total / wall, 1) if wall > 0 else None,
+        "peak_mem_mb": round (peak / 1024 / 1024, 2) if peak is not None else None,
+        "created": summary["created"],
+        "updated": summary["updated"],
+        "unchanged": summary["unchanged"],
+        "failed": len (errors),
+        "endpoints": counts,
+        "metrics": pos2cmine.metrics.toJson (),
+    }
+
+
+def benchmark (args):
+    results = []
+    for n in args.solutions:
+        port = args.port
+        server, url = startServer (args, n, port)
+        try:
+            work = tempfile.mkdtemp (prefix="pos2cmine-bench-")
+            indexFile = os.path.join (work, "index.db")
+            syncStart = datetime.datetime.now (tz.tzutc ())
+            r = runSync (args, url, indexFile)
+            r.update (solutions=n, run="full")
+            results.append (r)
+            requests.get ("{}/_touch?fraction={}".format (url, args.touch))
+            changed = pos2cmine.posChangedSince (syncStart, datetime.datetime.now (tz.tzutc ()))
+            r = runSync (args, url, indexFile, changed)
+            r.update (solutions=n, run="incremental")
+            results.append (r)
+        finally:
+            server.terminate ()
+            server.wait ()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser (description='Benchmark pos2cmine against a local mock PoS / CMINE')
+    parser.add_argument ('--solutions', help='Catalog sizes to run (number of PoS solutions)', type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument ('--others', help="Number of other users' ventures in the CMINE network", type=int, default=100)
+    parser.add_argument ('--latency', help='Latency of every mock request in seconds', type=float, default=0.01)
+    parser.add_argument ('--error-rate', help='Fraction of CMINE requests answered with 503', type=float, default=0.0)
+    parser.add_argument ('--rate-limit', help='CMINE requests allowed per second (sends X-RateLimit headers and 429)', type=int)
+    parser.add_argument ('--pos-page-size', help='Solutions per PoS page', type=int, default=10)
+    parser.add_argument ('--touch', help='Fraction of solutions changed before the incremental sync', type=float, default=0.01)
+    parser.add_argument ('--port', help='Port of the mock server', type=int, default=8765)
+
+    parser.add_argument ('--workers', type=int, default=1)
+    parser.add_argument ('--pos-prefetch', type=int, default=0)
+    parser.add_argument ('--pos-parallel', type=int, default=0)
+    parser.add_argument ('--cmine-parallel', type=int, default=4)
+    parser.add_argument ('--cmine-per-page', type=int, default=100)
+    parser.add_argument ('--metadata-ttl', help='Hours owner id and TRL attribute name are cached', type=float, default=24)
+    parser.add_argument ('--queue-size', type=int, default=100)
+    parser.add_argument ('--retries', type=int, default=4)
+    parser.add_argument ('--no-memory', help='Do not trace peak memory (tracing slows down the sync)', dest="memory", action="store_false")
+
+    parser.add_argument ('--json', help='Write results as JSON to this file')
+    parser.add_argument ('--serve', help='Only run the mock server', action="store_true")
+    args = parser.parse_args ()
+
+    if args.serve:
+        server = MockServer (args.port, args.solutions[0], args.others, args.latency, args.error_rate, args.rate_limit, args.pos_page_size)
+        print ("ready", flush=True)
+        server.serve_forever ()
+        exit (0)
+
+    results = benchmark (args)
+    print ("{:>9} {:>12} {:>9} {:>10} {:>9} {:>10} {:>8} {:>8} {:>8} {:>7}".format (
+        "solutions", "run", "requests", "wall [s]", "req/s", "peak [MB]", "created", "updated", "skipped", "failed"))
+    for r in results:
+        print ("{:>9} {:>12} {:>9} {:>10} {:>9} {:>10} {:>8} {:>8} {:>8} {:>7}".format (
+            r["solutions"], r["run"], r["requests"], r["wall_s"], r["requests_per_s"], r["peak_mem_mb"] if r["peak_mem_mb"] is not None else "-",
+            r["created"], r["updated"], r["unchanged"], r["failed"]))
+    if args.json:
+        with open (args.json, "w") as f:
+            json.dump (results, f, indent=2)
@@ -8,11 +8,27 @@ import datetime
 import iso8601
 from dateutil import tz
 import requests
+import requests.adapters
 import json
 import re
 from dotenv import load_dotenv
 import argparse
 import html
+import atexit
+import random
+import email.utils
+import time
+import sqlite3
+import hashlib
+import math
+import urllib.parse
+import threading
+import queue
+import collections
+import itertools
+import concurrent.futures
+import gzip
+import signal
 
 verbose = 0
 
@@ -20,24 +36,500 @@ venturesPath = "ventures"
 # New: should got there but does not work
 # venturesPath = "topics/13182/ventures"
 
-def readFromPos(url, offset=0):
-    """Get the next bunch of PoS solutions"""
-    headers = {'content-type': 'application/json', 'accept': 'application/json'}
+
+class RateLimiter:
+    """Token bucket for the requests to one host
+
+    Starts unlimited (or at max_rate) and follows what the server says:
+    the rate is set from the X-RateLimit-Remaining / -Reset headers,
+    Retry-After blocks all requests until then, and a 429 without such
+    headers halves the rate. After that every successful response raises
+    the rate a little again, up to max_rate (or unlimited).
+    """
+
+    # rate a 429 halves if there was no limit, and up to which it recovers
+    unlimited = 10.0
+    step = 0.5
+
+    def __init__ (self, max_rate=None, burst=5):
+        self.maxRate = max_rate
+        self.rate = max_rate
+        self.backedOff = False
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic ()
+        self.blockedUntil = 0
+        self.lock = threading.Lock ()
+
+    def acquire (self):
+        """Wait until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic ()
+                if now >= self.blockedUntil:
+                    if self.rate is None:
+                        return
+                    self.tokens = min (self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.blockedUntil - now
+            time.sleep (wait)
+
+    def blocked (self):
+        return time.monotonic () < self.blockedUntil
+
+    def update (self, response):
+        """Adjust the rate to the rate limit headers of a response"""
+        h = response.headers
+        now = time.monotonic ()
+        with self.lock:
+            retryAfter = parseRetryAfter (h.get ('Retry-After'))
+            if retryAfter is not None:
+                self.blockedUntil = max (self.blockedUntil, now + retryAfter)
+            remaining = h.get ('X-RateLimit-Remaining', h.get ('RateLimit-Remaining'))
+            reset = h.get ('X-RateLimit-Reset', h.get ('RateLimit-Reset'))
+            if remaining is not None and reset is not None:
+                try:
+                    remaining = int (remaining)
+                    reset = float (reset)
+                except ValueError:
+                    return
+                # either epoch seconds or seconds until the window resets
+                if reset > 1000000000:
+                    reset -= time.time ()
+                reset = max (reset, 1)
+                if remaining <= 0:
+                    self.blockedUntil = max (self.blockedUntil, now + reset)
+                else:
+                    self.rate = remaining / reset
+                    if self.maxRate is not None:
+                        self.rate = min (self.rate, self.maxRate)
+                    self.backedOff = False
+            elif response.status_code == 429:
+                self.rate = max (0.1, (self.rate or self.unlimited) / 2)
+                self.backedOff = True
+            elif self.backedOff and response.status_code < 400:
+                # additive increase, so a few 429s do not slow down a --watch forever
+                self.rate += self.step
+                ceiling = self.maxRate if self.maxRate is not None else self.unlimited
+                if self.rate >= ceiling:
+                    self.rate = self.maxRate
+                    self.backedOff = False
+
+
+def parseRetryAfter (value):
+    """Seconds from a Retry-After header (seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max (0, float (value))
+    except ValueError:
+        pass
+    try:
+        return max (0, (email.utils.parsedate_to_datetime (value) - datetime.datetime.now (tz.tzutc ())).total_seconds ())
+    except (TypeError, ValueError):
+        return None
+
+
+def endpointName (method, url):
+    """Name used in the metrics for a request"""
+    path = urllib.parse.urlsplit (url).path
+    if path.endswith ("/group_export"):
+        return "pos_page"
+    if path.endswith ("/oauth/token"):
+        return "oauth_token"
+    if re.search (r"/api/admin/v2/.*ventures$", path):
+        return "venture_list_page" if method == "GET" else "venture_post"
+    if re.search (r"/api/admin/v2/.*ventures/[^/]+$", path):
+        return "venture_{}".format (method.lower ())
+    if path.endswith ("/api/admin/v1/users"):
+        return "users"
+    if path.endswith ("/customizable_attributes"):
+        return "custom_attributes"
+    if path.endswith ("/api/admin/v1/me"):
+        return "me"
+    return "other"
+
+
+class Metrics:
+    """Timings and counters of one run
+
+    Written at the end of the run as JSON and as Prometheus textfile
+    (for the node_exporter textfile collector).
+    """
+
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.started = time.time ()
+        self.requests = {}
+        self.retries = collections.Counter ()
+        self.stages = collections.Counter ()
+        self.counters = collections.Counter ()
+        self.cleaning = collections.Counter ()
+
+    def observe (self, endpoint, seconds, sent=0, received=0):
+        """One HTTP request"""
+        with self.lock:
+            r = self.requests.get (endpoint)
+            if r is None:
+                r = self.requests[endpoint] = {"count": 0, "seconds": 0.0, "buckets": [0] * len (self.buckets), "bytes_sent": 0, "bytes_received": 0}
+            r["count"] += 1
+            r["seconds"] += seconds
+            for i, le in enumerate (self.buckets):
+                if seconds <= le:
+                    r["buckets"][i] += 1
+            r["bytes_sent"] += sent
+            r["bytes_received"] += received
+
+    def retry (self, endpoint):
+        with self.lock:
+            self.retries[endpoint] += 1
+
+    def count (self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def cleaned (self, saved, cached=False):
+        """One PoS summary cleaned (or taken from the cache), saving bytes"""
+        with self.lock:
+            self.cleaning["summaries"] += 1
+            self.cleaning["cache_hits"] += 1 if cached else 0
+            self.cleaning["bytes_saved"] += saved
+
+    def stage (self, name, seconds):
+        """Time spent busy in a sync stage"""
+        with self.lock:
+            self.stages[name] += seconds
+
+    def toJson (self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "duration_seconds": time.time () - self.started,
+                "requests": {k: dict (v, buckets=dict (zip (self.buckets, v["buckets"]))) for k, v in self.requests.items ()},
+                "retries": dict (self.retries),
+                "stage_seconds": dict (self.stages),
+                "counters": dict (self.counters),
+                "summary_cleaning": dict (self.cleaning),
+            }
+
+    def toPrometheus (self):
+        data = self.toJson ()
+        lines = []
+
+        def metric (name, kind, help, samples):
+            lines.append ("# HELP pos2cmine_{} {}".format (name, help))
+            lines.append ("# TYPE pos2cmine_{} {}".format (name, kind))
+            for labels, value in samples:
+                labels = ",".join ('{}="{}"'.format (k, v) for k, v in labels)
+                lines.append ("pos2cmine_{}{} {}".format (name, "{" + labels + "}" if labels else "", value))
+
+        lines.append ("# HELP pos2cmine_http_request_duration_seconds Latency of HTTP requests")
+        lines.append ("# TYPE pos2cmine_http_request_duration_seconds histogram")
+        for endpoint, r in sorted (data["requests"].items ()):
+            for le, n in list (r["buckets"].items ()) + [("+Inf", r["count"])]:
+                lines.append ('pos2cmine_http_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format (endpoint, le, n))
+            lines.append ('pos2cmine_http_request_duration_seconds_sum{{endpoint="{}"}} {}'.format (endpoint, r["seconds"]))
+            lines.append ('pos2cmine_http_request_duration_seconds_count{{endpoint="{}"}} {}'.format (endpoint, r["count"]))
+        metric ("http_sent_bytes_total", "counter", "Bytes of request bodies sent",
+                [([("endpoint", k)], v["bytes_sent"]) for k, v in sorted (data["requests"].items ())])
+        metric ("http_received_bytes_total", "counter", "Bytes of response bodies received",
+                [([("endpoint", k)], v["bytes_received"]) for k, v in sorted (data["requests"].items ())])
+        metric ("http_retries_total", "counter", "Retried HTTP requests", [([("endpoint", k)], v) for k, v in sorted (data["retries"].items ())])
+        metric ("stage_seconds_total", "counter", "Time spent busy in each sync stage", [([("stage", k)], v) for k, v in sorted (data["stage_seconds"].items ())])
+        metric ("ventures_total", "counter", "Ventures by result (created, updated, unchanged, deleted, failed)",
+                [([("result", k)], v) for k, v in sorted (data["counters"].items ())])
+        cleaning = data["summary_cleaning"]
+        metric ("summary_cleaned_total", "counter", "PoS summaries cleaned, by cache hit",
+                [([("cache", "hit")], cleaning.get ("cache_hits", 0)), ([("cache", "miss")], cleaning.get ("summaries", 0) - cleaning.get ("cache_hits", 0))])
+        metric ("summary_bytes_saved_total", "counter", "Bytes removed from PoS summaries (glossary blobs, whitespace)", [([], cleaning.get ("bytes_saved", 0))])
+        metric ("run_duration_seconds", "gauge", "Duration of the run", [([], data["duration_seconds"])])
+        metric ("run_start_timestamp_seconds", "gauge", "Start time of the run", [([], data["started"])])
+        return "\n".join (lines) + "\n"
+
+    def write (self, jsonPath=None, promPath=None):
+        """Write the metrics; each file is replaced only when complete"""
+        for path, text in [(jsonPath, lambda: json.dumps (self.toJson (), indent=2)), (promPath, self.toPrometheus)]:
+            if path is None:
+                continue
+            tmp = "{}.tmp".format (path)
+            with open (tmp, "w") as f:
+                f.write (text ())
+            os.replace (tmp, path)
+
+
+metrics = Metrics ()
+
+
+class HttpClient:
+    """Shared HTTP client for all PoS and CMINE calls
+
+    Keeps one keep-alive connection pool per host so pages and venture
+    writes reuse TCP+TLS connections instead of opening a new one each time.
+    """
+
+    retryStatus = (429, 500, 502, 503, 504)
+
+    def __init__ (self, pool_size=10, connect_timeout=10, read_timeout=60, hosts=4, retries=4, max_rate=None, backoff=1.0):
+        self.session = requests.Session ()
+        # pool_connections: number of hosts kept, pool_maxsize: connections per host
+        adapter = requests.adapters.HTTPAdapter (pool_connections=hosts, pool_maxsize=pool_size)
+        self.session.mount ("https://", adapter)
+        self.session.mount ("http://", adapter)
+        self.timeout = (connect_timeout, read_timeout)
+        self._headers = {'content-type': 'application/json', 'accept': 'application/json'}
+        self._authHeaders = {}
+        self.retries = retries
+        self.backoff = backoff
+        self.maxRate = max_rate
+        self.limiters = {}
+        self.lock = threading.Lock ()
+
+    def limiter (self, url):
+        """The rate limiter shared by all requests to the host of url"""
+        host = urllib.parse.urlsplit (url).netloc
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter (self.maxRate)
+            return self.limiters[host]
+
+    def headers (self, token=None):
+        """Request headers; the bearer headers are built once per token"""
+        if token is None:
+            return self._headers
+        if isinstance (token, TokenManager):
+            token = token.get ()
+        with self.lock:
+            headers = self._authHeaders.get (token)
+            if headers is None:
+                headers = dict (self._headers)
+                headers['Authorization'] = 'Bearer {}'.format (token)
+                # one token per CMINE target; drop refreshed (old) tokens now and then
+                if len (self._authHeaders) >= 16:
+                    self._authHeaders.clear ()
+                self._authHeaders[token] = headers
+        return headers
+
+    def request (self, method, url, token=None, data=None):
+        """Send one request; token may be a string or a TokenManager
+
+        Idempotent requests are retried with jittered exponential backoff on
+        429, 5xx and connection errors; POST only if it surely was not
+        processed (429, connect error).
+        """
+        limiter = self.limiter (url)
+        endpoint = endpointName (method, url)
+        sent = len (data) if data else 0
+        idempotent = method in ("GET", "PUT", "DELETE")
+        refreshed = False
+        attempt = 0
+        while True:
+            limiter.acquire ()
+            current = token.get () if isinstance (token, TokenManager) else token
+            start = time.perf_counter ()
+            try:
+                response = self.session.request (method, url, headers=self.headers (current), data=data, timeout=self.timeout)  # verify=False
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.observe (endpoint, time.perf_counter () - start, sent)
+                if attempt >= self.retries or not (idempotent or isinstance (e, requests.exceptions.ConnectTimeout)):
+                    raise
+                reason = str (e)
+            else:
+                metrics.observe (endpoint, time.perf_counter () - start, sent, len (response.content))
+                limiter.update (response)
+                if response.status_code == 401 and isinstance (token, TokenManager) and not refreshed:
+                    # expired or revoked: retry once with a fresh token
+                    if verbose:
+                        print ("CMINE: 401 for ", url, ", retrying with new token", file=sys.stderr)
+                    token.refresh (current)
+                    refreshed = True
+                    continue
+                retry = response.status_code == 429 or (idempotent and response.status_code in self.retryStatus)
+                if not retry or attempt >= self.retries:
+                    return response
+                reason = "status {}".format (response.status_code)
+            # a Retry-After already holds back the limiter
+            delay = 0 if limiter.blocked () else self.backoff * (2 ** attempt) * random.uniform (0.5, 1.5)
+            attempt += 1
+            metrics.retry (endpoint)
+            print ("{} {} failed ({}), retry {} of {}".format (method, url, reason, attempt, self.retries), file=sys.stderr)
+            time.sleep (delay)
+
+    def get (self, url, token=None):
+        return self.request ("GET", url, token)
+
+    def post (self, url, token=None, data=None):
+        return self.request ("POST", url, token, data)
+
+    def put (self, url, token=None, data=None):
+        return self.request ("PUT", url, token, data)
+
+    def delete (self, url, token=None):
+        return self.request ("DELETE", url, token)
+
+
+client = HttpClient ()
+
+
+class WorkerPool:
+    """Run jobs concurrently with a bounded number in flight
+
+    Errors are collected per job instead of aborting the whole run.
+    """
+
+    def __init__ (self, workers=1):
+        self.executor = concurrent.futures.ThreadPoolExecutor (max_workers=workers)
+        # submit blocks while all workers are busy
+        self.slots = threading.BoundedSemaphore (workers)
+        self.lock = threading.Lock ()
+        self.errors = []
+
+    def submit (self, name, fn, *args):
+        self.slots.acquire ()
+        try:
+            future = self.executor.submit (fn, *args)
+        except BaseException:
+            self.slots.release ()
+            raise
+        future.add_done_callback (lambda f: self._done (name, f))
+        return future
+
+    def _done (self, name, future):
+        self.slots.release ()
+        e = future.exception ()
+        if e is not None:
+            print ("Error processing '{}': {}".format (name, e), file=sys.stderr)
+            with self.lock:
+                self.errors.append ((name, e))
+
+    def join (self):
+        """Wait for all jobs, return list of (name, exception)"""
+        self.executor.shutdown (wait=True)
+        return self.errors
+
+
+def readFromPos(url, offset=0, changed=None):
+    """Get the next bunch of PoS solutions
+
+    changed: optional PoS filter like "-2 months" to get only recently changed solutions
+    """
     fullUrl = "{0}/en/group_export?_format=json&type=solution&may_reproduce=1&offset={1}".format (url, offset)
+    if changed:
+        fullUrl = "{0}&changed={1}".format (fullUrl, urllib.parse.quote (changed))
     if verbose:
         print ("< PoS: GET ", fullUrl, file=sys.stderr)
-    response = requests.get (fullUrl, headers=headers)  # verify=False
+    response = client.get (fullUrl)
     if response.status_code != 200:
         raise Exception ("Error getting PoS data: {0}".format (response.text))
     jsonData = response.json() if callable (response.json) else response.json
     return jsonData
 
 
-def posGenerator (url):
-    """Delivers PoS solutions"""
-    offset = 0
-    data = readFromPos (posUrl)
+def posPages (url, changed=None, offset=0):
+    """Delivers PoS pages one after the other"""
+    data = readFromPos (url, offset, changed)
     while len (data) > 0:
+        yield data
+        offset += len (data)
+        data = readFromPos (url, offset, changed)
+
+
+def posPagesPrefetch (url, pages, changed=None, offset=0):
+    """Delivers PoS pages read ahead by a background thread
+
+    Up to `pages` pages are kept ready while the consumer is still busy
+    with the current one.
+    """
+    ready = queue.Queue (maxsize=pages)
+    stop = threading.Event ()
+
+    def put (item):
+        while not stop.is_set ():
+            try:
+                ready.put (item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader ():
+        try:
+            for data in posPages (url, changed, offset):
+                if not put (data):
+                    return
+            put (None)
+        except Exception as e:
+            put (e)
+
+    threading.Thread (target=reader, name="pos-prefetch", daemon=True).start ()
+    try:
+        while True:
+            data = ready.get ()
+            if data is None:
+                return
+            if isinstance (data, Exception):
+                raise data
+            yield data
+    finally:
+        stop.set ()
+
+
+def posPagesParallel (url, width, changed=None, offset=0):
+    """Delivers PoS pages fetching `width` offsets at once
+
+    The page size is taken from the first page and every page is cut to
+    it, as the next one starts there. Stops at the first empty page;
+    requests beyond that are dropped. The rest of a short page is read
+    before going on, so no solution is skipped.
+    """
+    data = readFromPos (url, offset, changed)
+    if len (data) == 0:
+        return
+    yield data
+    size = len (data)
+    offset += size
+    executor = concurrent.futures.ThreadPoolExecutor (max_workers=width)
+    pending = collections.deque ()
+    try:
+        for i in range (width):
+            pending.append ((offset, executor.submit (readFromPos, url, offset, changed)))
+            offset += size
+        while pending:
+            pageOffset, future = pending.popleft ()
+            data = future.result ()[:size]
+            if len (data) == 0:
+                return
+            yield data
+            got = len (data)
+            while got < size:
+                data = readFromPos (url, pageOffset + got, changed)[:size - got]
+                if len (data) == 0:
+                    break
+                yield data
+                got += len (data)
+            pending.append ((offset, executor.submit (readFromPos, url, offset, changed)))
+            offset += size
+    finally:
+        for pageOffset, future in pending:
+            future.cancel ()
+        executor.shutdown (wait=False)
+
+
+def posGenerator (url, prefetch=0, parallel=0, changed=None, offset=0):
+    """Delivers PoS solutions, starting at offset"""
+    if parallel > 1:
+        pages = posPagesParallel (url, parallel, changed, offset)
+    elif prefetch > 0:
+        pages = posPagesPrefetch (url, prefetch, changed, offset)
+    else:
+        pages = posPages (url, changed, offset)
+    for data in pages:
         if verbose > 2:
             print (data, file=sys.stderr)
         for d in data:
@@ -45,13 +537,302 @@ def posGenerator (url):
             # 'AIR&#039;s Life and Health Models'
             d["title"] = html.unescape (d["title"])
             yield (d)
-        offset += len (data)
-        data = readFromPos (posUrl, offset)
 
 
-def getAuthToken (url, email, password, uid, secret):
-    """Get oauth token from cmine"""
-    headers = {'content-type': 'application/json', 'accept': 'application/json'}
+def openSnapshot (path, mode="r"):
+    """Open a snapshot file, gzip compressed if it ends with .gz; - is stdin / stdout"""
+    if path == "-":
+        return os.fdopen (os.dup ((sys.stdin if mode == "r" else sys.stdout).fileno ()), mode, encoding="utf-8")
+    if path.endswith (".gz"):
+        return gzip.open (path, mode + "t", encoding="utf-8")
+    return open (path, mode, encoding="utf-8")
+
+
+def writeSnapshot (solutions, path):
+    """Write solutions as they arrive, one JSON object per line (NDJSON)
+
+    Returns the number of solutions written.
+    """
+    n = 0
+    with openSnapshot (path, "w") as f:
+        for d in solutions:
+            f.write (json.dumps (d, ensure_ascii=False) + "\n")
+            n += 1
+    return n
+
+
+def readSnapshot (path, offset=0):
+    """Delivers the solutions of a snapshot written by writeSnapshot, starting at offset
+
+    Titles are already unescaped, like from posGenerator.
+    """
+    with openSnapshot (path) as f:
+        for line in itertools.islice (f, offset, None):
+            if line.strip ():
+                yield json.loads (line)
+
+
+def loadState (path):
+    """Read the persisted sync state (e.g. time of last sync)"""
+    if path is None or not os.path.exists (path):
+        return {}
+    with open (path) as f:
+        return json.load (f)
+
+
+def saveState (path, state):
+    """Write the sync state, replacing the old file only when complete"""
+    if path is None:
+        return
+    tmp = "{}.tmp".format (path)
+    with open (tmp, "w") as f:
+        json.dump (state, f, indent=2, sort_keys=True)
+    os.replace (tmp, path)
+
+
+TARGET_SETTINGS = ['cmine_url', 'cmine_email', 'cmine_password', 'cmine_owner', 'cmine_client_id', 'cmine_client_secret', 'token_cache', 'index_file']
+
+
+def loadTargets (path, defaults):
+    """Settings of the CMINE targets
+
+    Without a file there is the one target given by defaults (the
+    arguments). The file is a JSON list of objects with a "name" and the
+    settings in TARGET_SETTINGS, missing ones taken from defaults. The
+    index file of a target defaults to one per target name.
+    """
+    if path is None:
+        return [dict ({k: defaults.get (k) for k in TARGET_SETTINGS}, name=None)]
+    with open (path) as f:
+        config = json.load (f)
+    targets = []
+    for t in config:
+        target = {k: t.get (k, defaults.get (k)) for k in TARGET_SETTINGS}
+        target["name"] = t.get ("name") or target["cmine_url"]
+        if "index_file" not in t and len (config) > 1 and target["index_file"]:
+            root, ext = os.path.splitext (target["index_file"])
+            target["index_file"] = "{}.{}{}".format (root, re.sub (r"[^\w.-]+", "_", target["name"] or ""), ext)
+        targets.append (target)
+    if len (set (t["name"] for t in targets)) != len (targets):
+        raise Exception ("Names of CMINE targets in {} are not unique".format (path))
+    if len (set (t["index_file"] for t in targets)) != len (targets):
+        raise Exception ("CMINE targets in {} need different index files".format (path))
+    return targets
+
+
+def posChangedSince (since, now, overlap=10):
+    """PoS 'changed' filter covering everything changed after since
+
+    PoS only understands relative times like "-2 months", so round up to
+    minutes and add some overlap against clock skew.
+    """
+    minutes = math.ceil ((now - since).total_seconds () / 60) + overlap
+    return "-{} minutes".format (minutes)
+
+
+class CmineNotFound (Exception):
+    """CMINE does not know the venture (any more)"""
+
+
+class VentureIndex:
+    """Local SQLite index of our ventures on CMINE
+
+    Keeps id, pitch (name), updated_at, PoS key and the hash of the last
+    written payload. It is kept up to date from our own writes; a full
+    listing of CMINE ventures is only needed if the index is missing or
+    found to be inconsistent.
+    """
+
+    def __init__ (self, path):
+        self.lock = threading.Lock ()
+        self.db = sqlite3.connect (path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute ("CREATE TABLE IF NOT EXISTS ventures (id INTEGER PRIMARY KEY, pitch TEXT, updated_at TEXT, pos_key TEXT, payload_hash TEXT)")
+            self.db.execute ("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def isValid (self):
+        """True if the index was built from a full listing and not found inconsistent since"""
+        with self.lock:
+            row = self.db.execute ("SELECT value FROM meta WHERE key = 'valid'").fetchone ()
+        return row is not None and row[0] == "1"
+
+    def invalidate (self):
+        """Force a full listing on the next run"""
+        with self.lock, self.db:
+            self.db.execute ("INSERT OR REPLACE INTO meta (key, value) VALUES ('valid', '0')")
+
+    def rebuild (self, name2id):
+        """Replace the index with a full listing, keeping known hashes"""
+        with self.lock, self.db:
+            hashes = dict (self.db.execute ("SELECT id, payload_hash FROM ventures"))
+            posKeys = dict (self.db.execute ("SELECT id, pos_key FROM ventures"))
+            self.db.execute ("DELETE FROM ventures")
+            self.db.executemany ("INSERT INTO ventures (id, pitch, updated_at, pos_key, payload_hash) VALUES (?, ?, ?, ?, ?)",
+                                 [(d["id"], name, d["updated_at"], posKeys.get (d["id"]), hashes.get (d["id"])) for name, d in name2id.items ()])
+            self.db.execute ("INSERT OR REPLACE INTO meta (key, value) VALUES ('valid', '1')")
+            self.db.execute ("INSERT OR REPLACE INTO meta (key, value) VALUES ('listed', ?)", (str (time.time ()),))
+
+    def listedAge (self):
+        """Seconds since the last full listing, None if unknown"""
+        with self.lock:
+            row = self.db.execute ("SELECT value FROM meta WHERE key = 'listed'").fetchone ()
+        return time.time () - float (row[0]) if row else None
+
+    def name2id (self):
+        """Ventures by name, like getVentures"""
+        with self.lock:
+            rows = self.db.execute ("SELECT id, pitch, updated_at FROM ventures").fetchall ()
+        return {pitch: {"id": i, "still_exists": False, "updated_at": updated_at} for i, pitch, updated_at in rows}
+
+    def payloadHash (self, venture_id):
+        with self.lock:
+            row = self.db.execute ("SELECT payload_hash FROM ventures WHERE id = ?", (venture_id,)).fetchone ()
+        return row[0] if row else None
+
+    def store (self, venture_id, pitch, updated_at, pos_key, payload_hash):
+        with self.lock, self.db:
+            self.db.execute ("INSERT OR REPLACE INTO ventures (id, pitch, updated_at, pos_key, payload_hash) VALUES (?, ?, ?, ?, ?)",
+                             (venture_id, pitch, updated_at, pos_key, payload_hash))
+
+    def remove (self, venture_id):
+        with self.lock, self.db:
+            self.db.execute ("DELETE FROM ventures WHERE id = ?", (venture_id,))
+
+    def cached (self, key, ttl):
+        """Cached CMINE metadata (e.g. owner id) if younger than ttl seconds, else None"""
+        if not ttl or ttl <= 0:
+            return None
+        with self.lock:
+            row = self.db.execute ("SELECT value FROM meta WHERE key = ?", ("cache " + key,)).fetchone ()
+        if row is None:
+            return None
+        entry = json.loads (row[0])
+        if time.time () - entry["at"] > ttl:
+            return None
+        return entry["value"]
+
+    def cache (self, key, value):
+        with self.lock, self.db:
+            self.db.execute ("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                             ("cache " + key, json.dumps ({"value": value, "at": time.time ()})))
+
+    def clearCache (self):
+        with self.lock, self.db:
+            self.db.execute ("DELETE FROM meta WHERE key LIKE 'cache %'")
+
+    def close (self):
+        with self.lock:
+            self.db.close ()
+
+
+class Checkpoint:
+    """Journal of a sync run, so an interrupted run can be resumed
+
+    One JSON object per line: the run parameters, solutions committed
+    (written and confirmed by CMINE, or unchanged), the PoS offset up to
+    which all solutions are committed and pending / done deletes.
+    """
+
+    def __init__ (self, path):
+        self.path = path
+        self.lock = threading.Lock ()
+        self.f = None
+        self.run = None
+        self.done = set ()
+        self.offset = 0
+        self.deletes = {}
+        self.committed = set ()
+
+    def load (self):
+        """Read the journal of an interrupted run; False if there is none"""
+        if self.path is None or not os.path.exists (self.path):
+            return False
+        with open (self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads (line)
+                except ValueError:
+                    # last line of a killed run may be incomplete
+                    break
+                if "run" in entry:
+                    self.run = entry["run"]
+                if "done" in entry:
+                    self.done.add (entry["done"])
+                if "offset" in entry:
+                    self.offset = entry["offset"]
+                if "delete" in entry:
+                    self.deletes[(entry.get ("target"), entry["delete"])] = entry.get ("name")
+                if "deleted" in entry:
+                    self.deletes.pop ((entry.get ("target"), entry["deleted"]), None)
+        if self.run is None:
+            return False
+        self.f = open (self.path, "a")
+        return True
+
+    def start (self, run):
+        """Start a new journal"""
+        self.run = run
+        if self.path is not None:
+            self.f = open (self.path, "w")
+        self.write ({"run": run})
+
+    def write (self, entry):
+        if self.f is None:
+            return
+        with self.lock:
+            self.f.write (json.dumps (entry) + "\n")
+            self.f.flush ()
+
+    def commit (self, position, title):
+        """Solution at PoS position is done; advance the offset if possible"""
+        self.write ({"done": title})
+        with self.lock:
+            self.committed.add (position)
+            offset = self.offset
+            while offset in self.committed:
+                self.committed.remove (offset)
+                offset += 1
+            advanced = offset != self.offset
+            self.offset = offset
+        if advanced:
+            self.write ({"offset": offset})
+
+    def rewind (self):
+        """Start again at PoS offset 0, skipping the done solutions"""
+        with self.lock:
+            self.offset = 0
+            self.committed = set ()
+        self.write ({"offset": 0})
+
+    def delete (self, venture_id, name, target=None):
+        """Venture (of the CMINE target with this name) is going to be deleted"""
+        self.deletes[(target, venture_id)] = name
+        entry = {"delete": venture_id, "name": name}
+        if target is not None:
+            entry["target"] = target
+        self.write (entry)
+
+    def deleted (self, venture_id, target=None):
+        self.deletes.pop ((target, venture_id), None)
+        entry = {"deleted": venture_id}
+        if target is not None:
+            entry["target"] = target
+        self.write (entry)
+
+    def pending (self, target=None):
+        """Pending deletes of a CMINE target as (id, name)"""
+        return [(i, name) for (t, i), name in self.deletes.items () if t == target]
+
+    def finish (self):
+        """Run completed: the journal is not needed any more"""
+        if self.f is not None:
+            self.f.close ()
+            self.f = None
+            os.remove (self.path)
+
+
+def requestAuthToken (url, email, password, uid, secret):
+    """Get oauth token response (access_token, expires_in, created_at) from cmine"""
     data = {
         'grant_type': 'password',
         'scope': 'admin',
@@ -63,7 +844,7 @@ def getAuthToken (url, email, password, uid, secret):
     fullUrl = "{}/oauth/token".format (url)
     if verbose:
         print ("> CMINE: POST ", fullUrl, "data = ", data, file=sys.stderr)
-    response = requests.post (fullUrl, headers=headers, data=json.dumps (data))  # verify=False
+    response = client.post (fullUrl, data=json.dumps (data))
     if response.status_code != 200:
         # print ("Response: ", response, file=sys.stderr)
         print ("Response headers: ", response.headers, file=sys.stderr)
@@ -72,20 +853,86 @@ def getAuthToken (url, email, password, uid, secret):
     jsonData = response.json() if callable (response.json) else response.json
     if verbose > 2:
         print ("Response data: ", json.dumps (jsonData, indent=2), file=sys.stderr)
-    return jsonData['access_token']
+    return jsonData
+
+
+class TokenManager:
+    """CMINE oauth token reused until shortly before it expires
+
+    The token and its expiry are kept in memory and, if a path is given,
+    in a file only readable by the user so later runs can reuse it.
+    """
+
+    # several managers may share one file
+    saveLock = threading.Lock ()
+
+    def __init__ (self, url, email, password, uid, secret, path=None, margin=300):
+        self.url = url
+        self.credentials = (email, password, uid, secret)
+        self.path = path
+        self.margin = margin
+        # one file may hold tokens for several CMINE instances / admins
+        self.key = "{} {} {}".format (url, email, uid)
+        self.lock = threading.Lock ()
+        self.token = None
+        self.expires = None
+        if path is not None and os.path.exists (path):
+            with open (path) as f:
+                cached = json.load (f).get (self.key)
+            if cached:
+                self.token = cached["access_token"]
+                self.expires = cached["expires_at"]
+
+    def _valid (self):
+        return self.token is not None and (self.expires is None or time.time () < self.expires - self.margin)
+
+    def get (self):
+        """Current access token, refreshed if (nearly) expired"""
+        with self.lock:
+            if not self._valid ():
+                self._refresh ()
+            return self.token
+
+    def refresh (self, rejected=None):
+        """Get a new token, e.g. after CMINE rejected token 'rejected' with 401"""
+        with self.lock:
+            # another thread may have refreshed it already
+            if rejected is None or rejected == self.token:
+                self._refresh ()
+            return self.token
+
+    def _refresh (self):
+        if verbose:
+            print ("Getting new CMINE oauth token", file=sys.stderr)
+        jsonData = requestAuthToken (self.url, *self.credentials)
+        self.token = jsonData['access_token']
+        self.expires = None
+        if jsonData.get ('expires_in'):
+            self.expires = jsonData.get ('created_at', time.time ()) + jsonData['expires_in']
+        if self.path is not None:
+            self._save ()
+
+    def _save (self):
+        with TokenManager.saveLock:
+            cached = {}
+            if os.path.exists (self.path):
+                with open (self.path) as f:
+                    cached = json.load (f)
+            cached[self.key] = {"access_token": self.token, "expires_at": self.expires}
+            tmp = "{}.tmp".format (self.path)
+            fd = os.open (tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen (fd, "w") as f:
+                json.dump (cached, f)
+            os.replace (tmp, self.path)
 
 
 def getMyUserId (url, token):
     """Get own user id from cmine"""
-    headers = {
-        'content-type': 'application/json',
-        'accept': 'application/json',
-        'Authorization': 'Bearer {}'.format (token)
-        }
+    headers = client.headers (token)
     fullUrl = "{}/api/admin/v1/me".format (url)
     if verbose:
         print ("< CMINE: GET ", fullUrl, "headers = ", headers, file=sys.stderr)
-    response = requests.get (fullUrl, headers=headers)  # verify=False
+    response = client.get (fullUrl, token=token)
     if response.status_code != 200:
         # print ("Response: ", response, file=sys.stderr)
         print ("Response headers: ", response.headers, file=sys.stderr)
@@ -97,110 +944,179 @@ def getMyUserId (url, token):
     return jsonData["admin"]["id"]
 
 
-def getUserId (url, token, user_email):
-    """Get user id for given user from cmine"""
-    headers = {
-        'content-type': 'application/json',
-        'accept': 'application/json',
-        'Authorization': 'Bearer {}'.format (token)
-        }
-    fullUrl = "{}/api/admin/v1/users".format (url)
+def getUserId (url, token, user_email, per_page=None):
+    """Get user id for given user from cmine
+
+    Asks CMINE to filter the users by email. Servers ignoring the filter
+    deliver all users, so the pages are searched until the user is found.
+    """
+    query = {"email": user_email}
+    if per_page:
+        query["per_page"] = per_page
+    fullUrl = "{}/api/admin/v1/users?{}".format (url, urllib.parse.urlencode (query))
+    while fullUrl is not None:
+        if verbose:
+            print ("< CMINE: GET ", fullUrl, file=sys.stderr)
+        response = client.get (fullUrl, token=token)
+        if response.status_code in (400, 422) and "email=" in fullUrl:
+            # filter not supported: search all users
+            fullUrl = "{}/api/admin/v1/users".format (url)
+            if per_page:
+                fullUrl = pageUrl (fullUrl, 1, per_page)
+            continue
+        if response.status_code != 200:
+            # print ("Response: ", response, file=sys.stderr)
+            print ("Response headers: ", response.headers, file=sys.stderr)
+            print ("Response text: ", response.text, file=sys.stderr)
+            raise Exception ("Error gettung users from CMINE: {0}".format (response.text))
+        jsonData = response.json() if callable (response.json) else response.json
+        if verbose > 1:
+            print ("Response data: ", json.dumps (jsonData, indent=2), file=sys.stderr)
+        ids = [u["id"] for u in jsonData["users"] if u["email"].lower () == user_email.lower ()]
+        if len (ids) > 0:
+            return ids[0]
+        fullUrl = parseLinks (response.headers.get ("Link")).get ("next")
+    raise Exception ("Error gettung userId for {} from CMINE: not found".format (user_email))
+
+
+def getCustomAttributes (url, token, pattern=None):
+    """Search for configured attributes in cmine"""
+    headers = client.headers (token)
+    fullUrl = "{}/api/admin/v1/settings/customizable_attributes".format (url)
     if verbose:
         print ("< CMINE: GET ", fullUrl, "headers = ", headers, file=sys.stderr)
-    response = requests.get (fullUrl, headers=headers)  # verify=False
+    response = client.get (fullUrl, token=token)
     if response.status_code != 200:
         # print ("Response: ", response, file=sys.stderr)
         print ("Response headers: ", response.headers, file=sys.stderr)
         print ("Response text: ", response.text, file=sys.stderr)
-        raise Exception ("Error gettung users from CMINE: {0}".format (response.text))
+        raise Exception ("Error getting 'pages_customizable' from CMINE: {0}".format (response.text))
     jsonData = response.json() if callable (response.json) else response.json
     if verbose > 1:
         print ("Response data: ", json.dumps (jsonData, indent=2), file=sys.stderr)
-    ids = [u["id"] for u in jsonData["users"] if u["email"] == user_email]
-    if len (ids) == 0:
-        raise Exception ("Error gettung userId for {} from CMINE: not found".format (user_email))
-    return ids[0]
+    return [a["name"] for a in jsonData["customizable_attributes"] if (pattern is None) or re.search (pattern, a["display_name"], re.IGNORECASE)]
 
 
-def getCustomAttributes (url, token, pattern=None):
-    """Search for configured attributes in cmine"""
-    headers = {
-        'content-type': 'application/json',
-        'accept': 'application/json',
-        'Authorization': 'Bearer {}'.format (token)
-        }
-    fullUrl = "{}/api/admin/v1/settings/customizable_attributes".format (url)
+def parseLinks (header):
+    """Links of a `Link` header by rel"""
+    links = {}
+    for link in (header or "").split (", "):
+        m = re.match (r'^<([^>]*)>.*rel="([^"]*)"', link)
+        if m:
+            links[m.group (2)] = m.group (1)
+    return links
+
+
+def pageUrl (url, page, per_page=None):
+    """url with the page (and per_page) query parameter replaced"""
+    parts = urllib.parse.urlsplit (url)
+    query = dict (urllib.parse.parse_qsl (parts.query))
+    query["page"] = str (page)
+    if per_page:
+        query["per_page"] = str (per_page)
+    return urllib.parse.urlunsplit (parts._replace (query=urllib.parse.urlencode (query)))
+
+
+def getVenturesPage (fullUrl, token):
+    """One page of the CMINE venture listing as (ventures, response headers)"""
     if verbose:
-        print ("< CMINE: GET ", fullUrl, "headers = ", headers, file=sys.stderr)
-    response = requests.get (fullUrl, headers=headers)  # verify=False
+        print ("< CMINE: GET ", fullUrl, file=sys.stderr)
+    response = client.get (fullUrl, token=token)
     if response.status_code != 200:
         # print ("Response: ", response, file=sys.stderr)
         print ("Response headers: ", response.headers, file=sys.stderr)
         print ("Response text: ", response.text, file=sys.stderr)
-        raise Exception ("Error getting 'pages_customizable' from CMINE: {0}".format (response.text))
+        raise Exception ("Error getting ventures from CMINE: {0}".format (response.text))
     jsonData = response.json() if callable (response.json) else response.json
     if verbose > 1:
+        print ("Response headers: ", response.headers, file=sys.stderr)
         print ("Response data: ", json.dumps (jsonData, indent=2), file=sys.stderr)
-    return [a["name"] for a in jsonData["customizable_attributes"] if (pattern is None) or re.search (pattern, a["display_name"], re.IGNORECASE)]
+    return jsonData["ventures"], response.headers
+
+
+def lastPage (links, headers, size):
+    """Number of the last page of a listing, or None if not known
+
+    Taken from the rel="last" link, else computed from the total count
+    (X-Total) and the page size actually used by the server: size of the
+    first (full) page, the server may use less than per_page asked for.
+    """
+    if "last" in links:
+        page = urllib.parse.parse_qs (urllib.parse.urlsplit (links["last"]).query).get ("page")
+        if page:
+            return int (page[0])
+    total = headers.get ("X-Total") or headers.get ("X-Total-Count")
+    if total:
+        size = int (headers.get ("X-Per-Page") or size)
+        if size > 0:
+            return max (1, math.ceil (int (total) / size))
+    return None
+
+
+def getVentures (url, token, user_id=None, duplicates=None, parallel=1, per_page=None):
+    """list ventures on CMINE
 
+    If the first page tells the number of pages (rel="last" link or total
+    count), the remaining pages are fetched `parallel` at once, otherwise
+    rel="next" links are followed one by one. Pages are merged in order,
+    so the first of ventures with the same name is always kept.
 
-def getVentures (url, token, user_id=None):
-    """list ventures on CMINE"""
+    Ventures with a name already seen are appended as (id, name) to
+    duplicates, to be deleted after the listing. They are not in the
+    result, so callers must not pass duplicates=None if they need them.
+    """
     result = {}
-    headers = {
-        'content-type': 'application/json',
-        'accept': 'application/json',
-        'Authorization': 'Bearer {}'.format (token)
-        }
     fullUrl = "{}/api/admin/v2/{}".format (url, venturesPath)
     # This does NOT work
     # if user_id:
     #     fullUrl = "{}?user_id={}".format (fullUrl, user_id)
-    while fullUrl is not None:
-        if verbose:
-            print ("< CMINE: GET ", fullUrl, "headers = ", headers, file=sys.stderr)
-        response = requests.get (fullUrl, headers=headers)  # verify=False
-        if response.status_code != 200:
-            # print ("Response: ", response, file=sys.stderr)
-            print ("Response headers: ", response.headers, file=sys.stderr)
-            print ("Response text: ", response.text, file=sys.stderr)
-            raise Exception ("Error getting ventures from CMINE: {0}".format (response.text))
-        jsonData = response.json() if callable (response.json) else response.json
-        if verbose > 1:
-            print ("Response headers: ", response.headers, file=sys.stderr)
-            print ("Response data: ", json.dumps (jsonData, indent=2), file=sys.stderr)
+    if per_page:
+        fullUrl = pageUrl (fullUrl, 1, per_page)
+
+    def add (ventures):
         # this was really nice but can not detect duplicate names
-        # result.update ({v["high_level_pitch"]: {"id": v["id"], "still_exists": False, "updated_at": v["updated_at"]} for v in jsonData["ventures"] if user_id is None or user_id == v["user_id"]})
+        # result.update ({v["high_level_pitch"]: {"id": v["id"], "still_exists": False, "updated_at": v["updated_at"]} for v in ventures if user_id is None or user_id == v["user_id"]})
         # so use this instead:
-        for v in jsonData["ventures"]:
+        for v in ventures:
             if user_id is None or user_id == v["user_id"]:
                 # this are my ventures
                 if v["high_level_pitch"] in result:
-                    print ("Delete duplicate venture:", v["high_level_pitch"], file=sys.stderr)
-                    deleteVenture (url, token, v["id"])
+                    print ("Duplicate venture:", v["high_level_pitch"], file=sys.stderr)
+                    if duplicates is not None:
+                        duplicates.append ((v["id"], v["high_level_pitch"]))
                 else:
                     result[v["high_level_pitch"]] = {"id": v["id"], "still_exists": False, "updated_at": v["updated_at"]}
 
-        fullUrl = None
-        if 'Link' in response.headers:
-            # print ("Link: ", response.headers["Link"], file=sys.stderr)
-            for link in response.headers["Link"].split (", "):
-                if link.endswith('rel="next"'):
-                    fullUrl = re.sub ("^<|>.*$", "", link)
+    ventures, headers = getVenturesPage (fullUrl, token)
+    add (ventures)
+    links = parseLinks (headers.get ("Link"))
+    last = lastPage (links, headers, len (ventures)) if parallel > 1 and "next" in links else None
+    if last is not None:
+        urls = [pageUrl (links["next"], page) for page in range (2, last + 1)]
+        with concurrent.futures.ThreadPoolExecutor (max_workers=parallel) as executor:
+            # map delivers the pages in order
+            for ventures, headers in executor.map (lambda u: getVenturesPage (u, token), urls):
+                add (ventures)
+        return result
+    while "next" in links:
+        ventures, headers = getVenturesPage (links["next"], token)
+        add (ventures)
+        links = parseLinks (headers.get ("Link"))
     return result
 
 
 def deleteVenture (url, token, venture_id):
     """Delete one venture on CMINE"""
-    headers = {
-        'content-type': 'application/json',
-        'accept': 'application/json',
-        'Authorization': 'Bearer {}'.format (token)
-        }
+    headers = client.headers (token)
     fullUrl = "{}/api/admin/v2/{}/{}".format (url, venturesPath, venture_id)
     if verbose:
         print ("> CMINE: DELETE ", fullUrl, "headers = ", headers, file=sys.stderr)
-    response = requests.delete (fullUrl, headers=headers)  # verify=False
+    response = client.delete (fullUrl, token=token)
+    if response.status_code == 404:
+        # already gone, e.g. deleted by an interrupted run
+        if verbose:
+            print ("Venture {} already deleted".format (venture_id), file=sys.stderr)
+        return
     if response.status_code != 204:
         # print ("Response: ", response, file=sys.stderr)
         print ("Response headers: ", response.headers, file=sys.stderr)
@@ -208,14 +1124,74 @@ def deleteVenture (url, token, venture_id):
         raise Exception ("Error deleting ventures with id {2} from CMINE: {0} {1}".format (response.status_code, response.text, venture_id))
 
 
-def writeToCmine (url, token, user_id, venture_id, trl_attr_name, p, posUrl):
-    """Write one Solution to CMINE"""
-    global lastUpdated
-    if verbose > 1:
-        print ("*" * 50, file=sys.stderr)
-    print ("Processing {}".format (p["title"]), file=sys.stderr)
-    if verbose > 1:
-        print ("PoS: ", json.dumps (p, indent=2), file=sys.stderr)
+def deleteVentures (url, token, ventures, workers=1, index=None, checkpoint=None, target=None):
+    """Delete ventures given as (id, name) using a pool of workers
+
+    target: name of the CMINE target in the checkpoint, if there are several.
+    Returns the list of (name, exception) of failed deletes.
+    """
+    ventures = list (ventures)
+    if checkpoint is not None:
+        for venture_id, name in ventures:
+            if (target, venture_id) not in checkpoint.deletes:
+                checkpoint.delete (venture_id, name, target)
+
+    def delete (venture_id, name):
+        print ("! CMINE: delete '{}'".format (name), file=sys.stderr)
+        deleteVenture (url, token, venture_id)
+        if index is not None:
+            index.remove (venture_id)
+        if checkpoint is not None:
+            checkpoint.deleted (venture_id, target)
+        metrics.count ("deleted")
+
+    deleters = WorkerPool (workers)
+    for venture_id, name in ventures:
+        deleters.submit (name, delete, venture_id, name)
+    return deleters.join ()
+
+
+# PoS puts glossary tooltips into the summary: the definition of a term
+# followed by "read more", e.g.
+#   <p>Sudden, urgent, usually unexpected occurrence ...</p>&#13;\n<p>\n    \n    read more    \n    </p>
+# The definition has no paragraphs of its own, so match <p> ... </p>
+# without <p> or </p> in between.
+GLOSSARY_BLOB = re.compile (r'\s*<p>[^<]*(?:<(?!/?p[\s>/])[^<]*)*</p>\s*(?:&#13;\s*)?<p>\s*read more\s*</p>\s*', re.IGNORECASE)
+CARRIAGE_RETURN = re.compile (r'&#13;|&#x0*d;', re.IGNORECASE)
+WHITESPACE = re.compile (r'\s+')
+
+summaryCache = {}
+summaryCacheLock = threading.Lock ()
+
+
+def cleanSummary (text, cacheSize=10000):
+    """PoS summary without glossary blobs, carriage returns and repeated whitespace
+
+    Results are cached by a hash of the summary.
+    """
+    key = hashlib.sha1 (text.encode ("utf-8")).digest ()
+    with summaryCacheLock:
+        cached = summaryCache.get (key)
+    if cached is not None:
+        metrics.cleaned (cached[1], cached=True)
+        return cached[0]
+    cleaned = GLOSSARY_BLOB.sub (" ", text)
+    cleaned = CARRIAGE_RETURN.sub ("", cleaned)
+    cleaned = WHITESPACE.sub (" ", cleaned).strip ()
+    saved = len (text.encode ("utf-8")) - len (cleaned.encode ("utf-8"))
+    with summaryCacheLock:
+        if len (summaryCache) >= cacheSize:
+            summaryCache.clear ()
+        summaryCache[key] = (cleaned, saved)
+    metrics.cleaned (saved)
+    return cleaned
+
+
+def mapBase (p):
+    """Map one PoS solution to the part of a CMINE venture common to all CMINE instances
+
+    Pure function without any network access; see mapTarget for the rest.
+    """
     #   Map and send
     #     {
     #   "venture[company_name]": "Hello, world!",
@@ -292,11 +1268,10 @@ def writeToCmine (url, token, user_id, venture_id, trl_attr_name, p, posUrl):
         "venture": {
             # From PoS
             "high_level_pitch": p["title"],
-            "product": p["summary"] if p["summary"] else "Blank",
+            "product": (cleanSummary (p["summary"]) if p["summary"] else "") or "Blank",
             # "product": p["summary_short"] if p["summary_short"] else "Blank",
             "company_name": p["provider"] if p["provider"] else "DRIVER+",
             "company_website": "{}{}".format (p["base_url"], p["group_uri"]),
-            "user_id": user_id,   # the user with the same email as the admin doing the import
             "logo": "https://s3-eu-west-1.amazonaws.com/kit-eu-preprod/assets/networks/550/picture/-original.jpg?1567692929",
             "business_stage": "unknown",
             # "business_stage": p["innovation_stage"],   # Response text:  {"status":400,"errors":"venture[business_stage] does not have a valid value"}
@@ -327,7 +1302,17 @@ def writeToCmine (url, token, user_id, venture_id, trl_attr_name, p, posUrl):
             # see https://www.urldecoder.io/python/
             # https://stackoverflow.com/questions/44188759/auto-embeding-videos-from-youtube-python-html
             c["venture"]["video_html"] = link
+    return c
+
 
+def mapTarget (base, p, user_id, trl_attr_name):
+    """Complete the mapped venture base for one CMINE instance
+
+    Owner and the name of the TRL attribute differ between instances.
+    base is not changed, so it can be used for several instances.
+    """
+    c = {"venture": dict (base["venture"])}
+    c["venture"]["user_id"] = user_id   # the user with the same email as the admin doing the import
     if trl_attr_name is not None:
         if "trl" in p:
             c["venture"]["customizable_attributes"] = [
@@ -338,44 +1323,506 @@ def writeToCmine (url, token, user_id, venture_id, trl_attr_name, p, posUrl):
                     ]
                 }
             ]
+    return c
+
+
+def diffSnapshots (old, new):
+    """Changes from snapshot old to snapshot new as (change, title)
+
+    change is "+" (new solution), "-" (removed) or "~" (content sent to
+    CMINE changed). Only hashes of the old snapshot are kept in memory.
+    """
+    def contentHash (d):
+        # owner and TRL attribute name are the same for both snapshots,
+        # but the TRL value is part of the content
+        return payloadHash (mapSolution (d, None, "trl"))
+
+    hashes = {}
+    for d in readSnapshot (old):
+        hashes[d["title"]] = contentHash (d)
+    for d in readSnapshot (new):
+        h = hashes.pop (d["title"], None)
+        if h is None:
+            yield ("+", d["title"])
+        elif h != contentHash (d):
+            yield ("~", d["title"])
+    for title in hashes:
+        yield ("-", title)
+
 
+def mapSolution (p, user_id, trl_attr_name):
+    """Map one PoS solution to a CMINE venture
+
+    Pure function without any network access.
+    """
+    return mapTarget (mapBase (p), p, user_id, trl_attr_name)
+
+
+def payloadHash (c):
+    """Stable hash of a mapped venture, used to detect changes"""
+    return hashlib.sha256 (json.dumps (c, sort_keys=True, separators=(',', ':')).encode ('utf-8')).hexdigest ()
+
+
+def writeToCmine (url, token, venture_id, c):
+    """Write one venture to CMINE, returns the venture as stored by CMINE"""
+    title = c["venture"]["high_level_pitch"]
+    if verbose > 1:
+        print ("*" * 50, file=sys.stderr)
+    print ("Processing {}".format (title), file=sys.stderr)
     if verbose > 1:
         print ("CMINE: ", json.dumps (c, indent=2), file=sys.stderr)
 
     # post or put c
-    headers = {
-        'content-type': 'application/json',
-        'accept': 'application/json',
-        'Authorization': 'Bearer {}'.format (token)
-        }
     fullUrl = "{}/api/admin/v2/{}".format (url, venturesPath)
     if venture_id is None:
         if verbose:
             print ("> CMINE: POST ", fullUrl, file=sys.stderr)
-        response = requests.post (fullUrl, headers=headers, data=json.dumps (c))  # verify=False
+        response = client.post (fullUrl, token=token, data=json.dumps (c))
     else:
         fullUrl = "{}/{}".format (fullUrl, venture_id)
         # location: id needed in PUT! So...
+        c = {"venture": dict (c["venture"])}
         c["venture"].pop ("locations", None)
         if verbose:
             print ("> CMINE: PUT ", fullUrl, file=sys.stderr)
-        response = requests.put (fullUrl, headers=headers, data=json.dumps (c))  # verify=False
+        response = client.put (fullUrl, token=token, data=json.dumps (c))
+    if response.status_code == 404 and venture_id is not None:
+        raise CmineNotFound ("Venture {} for '{}' not found on CMINE".format (venture_id, title))
     if response.status_code not in [200, 201]:
         if verbose <= 1:
             print ("CMINE: ", json.dumps (c, indent=2), file=sys.stderr)
         # print ("Response: ", response, file=sys.stderr)
         print ("Response headers: ", response.headers, file=sys.stderr)
         print ("Response text: ", response.text, file=sys.stderr)
-        raise Exception ("Error posting '{2}' to CMINE: {0} {0}".format (response.status_code, response.text, p["title"]))
+        raise Exception ("Error posting '{2}' to CMINE: {0} {1}".format (response.status_code, response.text, title))
     if verbose > 1:
         print ("Response headers: ", response.headers, file=sys.stderr)
         print ("Response text: ", response.text, file=sys.stderr)
+    try:
         jsonData = response.json() if callable (response.json) else response.json
+    except ValueError:
+        return {"id": venture_id}
+    if verbose > 1:
         print ("CMINE Response data: ", json.dumps (jsonData, indent=2), file=sys.stderr)
+    return jsonData.get ("venture", {"id": venture_id})
 
     # tc = iso8601.parse_date(d["last_changed_on"])   # "2018-11-30T11:54:00+0100"
 
 
+PIPELINE_END = object ()
+
+
+def pipeline (source, stages, sink, size=100):
+    """Run source -> stages -> sink concurrently, connected by bounded queues
+
+    Each stage is a function taking one item and returning the item for the
+    next stage (None drops it); it runs in its own thread. The sink runs in
+    the calling thread. A full queue holds back the stages before it, so
+    memory stays flat. The first exception of any stage stops the
+    pipeline and is raised.
+    """
+    stop = threading.Event ()
+    failed = []
+    queues = [queue.Queue (maxsize=size) for i in range (len (stages) + 1)]
+
+    def put (q, item):
+        while not stop.is_set ():
+            try:
+                q.put (item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get (q):
+        while not stop.is_set ():
+            try:
+                return q.get (timeout=0.5)
+            except queue.Empty:
+                pass
+        return PIPELINE_END
+
+    def produce ():
+        try:
+            for item in source:
+                if not put (queues[0], item):
+                    return
+            put (queues[0], PIPELINE_END)
+        except Exception as e:
+            failed.append (e)
+            stop.set ()
+
+    def work (fn, inbox, outbox):
+        try:
+            while True:
+                item = get (inbox)
+                if item is PIPELINE_END:
+                    put (outbox, PIPELINE_END)
+                    return
+                start = time.perf_counter ()
+                result = fn (item)
+                metrics.stage (fn.__name__, time.perf_counter () - start)
+                if result is not None and not put (outbox, result):
+                    return
+        except Exception as e:
+            failed.append (e)
+            stop.set ()
+
+    threads = [threading.Thread (target=produce, name="pipeline-source", daemon=True)]
+    for i, fn in enumerate (stages):
+        threads.append (threading.Thread (target=work, args=(fn, queues[i], queues[i + 1]), name="pipeline-{}".format (fn.__name__), daemon=True))
+    for t in threads:
+        t.start ()
+    try:
+        while True:
+            item = get (queues[-1])
+            if item is PIPELINE_END:
+                break
+            start = time.perf_counter ()
+            sink (item)
+            metrics.stage (sink.__name__, time.perf_counter () - start)
+    finally:
+        stop.set ()
+        for t in threads:
+            t.join ()
+    if failed:
+        raise failed[0]
+
+
+class CmineTarget:
+    """One CMINE instance the solutions are written to
+
+    Owner user id, venture list and TRL attribute name are discovered on
+    first use, so runs without any PoS solution do not need to log in.
+    Owner id and TRL attribute name are cached in the index for
+    metadata_ttl seconds. Each target has its own token, index and pool
+    of writers.
+    """
+
+    def __init__ (self, url, token, owner, index, parallel=1, per_page=None, name=None, metadata_ttl=None, reconcile_after=None):
+        self.url = url
+        self.token = token
+        self.owner = owner
+        self.index = index
+        # venture listing: pages fetched at once, ventures per page
+        self.parallel = parallel
+        self.per_page = per_page
+        # used in the checkpoint and messages if there are several targets
+        self.name = name
+        self.metadata_ttl = metadata_ttl
+        # seconds after which the index is checked against a full listing
+        self.reconcile_after = reconcile_after
+        self.user_id = None
+        self.trl_attr_name = None
+        self.name2id = None
+        # duplicate ventures found while listing, deleted after the sync
+        self.duplicates = []
+        self.lock = threading.Lock ()
+
+    def reconcileDue (self):
+        """Index older than reconcile_after: list CMINE, so ventures deleted
+        (or created) on CMINE behind our back are noticed"""
+        if self.reconcile_after is None:
+            return False
+        age = self.index.listedAge ()
+        return age is None or age > self.reconcile_after
+
+    def prepare (self):
+        """Discover owner, own ventures and TRL attribute name (once)"""
+        with self.lock:
+            if self.name2id is not None:
+                return
+            self.user_id = self.index.cached ("owner_id " + self.owner, self.metadata_ttl)
+            if self.user_id is None:
+                self.user_id = getUserId (self.url, self.token, self.owner, self.per_page)
+                self.index.cache ("owner_id " + self.owner, self.user_id)
+            if self.index.isValid () and not self.reconcileDue ():
+                name2id = self.index.name2id ()
+            else:
+                # index missing, inconsistent or due: full listing;
+                # rebuild keeps the hashes of ventures still there
+                name2id = getVentures(self.url, self.token, self.user_id, self.duplicates, self.parallel, self.per_page)
+                self.index.rebuild (name2id)
+            if verbose:
+                print ("Available on CMINE: ", name2id.keys(), file=sys.stderr)
+            self.trl_attr_name = self.index.cached ("trl_attr_name", self.metadata_ttl)
+            if self.trl_attr_name is None:
+                trl_attr_names = getCustomAttributes (self.url, self.token, "(Trl)")
+                if len (trl_attr_names) == 1:
+                    self.trl_attr_name = trl_attr_names[0]
+                    self.index.cache ("trl_attr_name", self.trl_attr_name)
+                else:
+                    print ("Could not identify TRL custom attribute. Candidates are ", trl_attr_names)
+            # testAccessToken (cmineUrl, token)
+            self.name2id = name2id
+
+    def reset (self):
+        """Forget name2id and duplicates; the next prepare reloads them from the index"""
+        with self.lock:
+            self.name2id = None
+            self.duplicates = []
+
+
+def prepareTargets (targets):
+    """Prepare all targets concurrently"""
+    if len (targets) == 1:
+        targets[0].prepare ()
+        return
+    with concurrent.futures.ThreadPoolExecutor (max_workers=len (targets)) as executor:
+        futures = [executor.submit (t.prepare) for t in targets]
+        for f in futures:
+            f.result ()
+
+
+def syncToCmine (solutions, targets, workers=1, summary=None, queue_size=100, checkpoint=None):
+    """Write PoS solutions to one or several CMINE targets
+
+    Runs as a pipeline: fetch (iterating solutions) -> map -> diff -> write,
+    the writes going to a pool of workers per target. Each solution is
+    fetched and mapped once for all targets. Returns the list of
+    (name, exception) of failed writes; still_exists is set in
+    name2id of the targets for all solutions seen.
+
+    With a checkpoint, solutions are expected to start at checkpoint.offset;
+    solutions written to all targets are journaled and those already done
+    are skipped.
+    """
+    if isinstance (targets, CmineTarget):
+        targets = [targets]
+    if summary is None:
+        summary = collections.Counter ()
+    writers = [WorkerPool (workers) for t in targets]
+    offset = checkpoint.offset if checkpoint is not None else 0
+    # writes still running per PoS position
+    running = {}
+    runningLock = threading.Lock ()
+    summaryLock = threading.Lock ()
+
+    def count (result):
+        # diff stage and writers count concurrently; the run metrics are
+        # counted here too, so they only see confirmed writes
+        with summaryLock:
+            summary[result] += 1
+        metrics.count (result)
+
+    def label (target, title):
+        return title if len (targets) == 1 else "{}: {}".format (target.name, title)
+
+    def mapStage (item):
+        position, d = item
+        if verbose > 2:
+            print (d, file=sys.stderr)
+        prepareTargets (targets)
+        if checkpoint is not None and d["title"] in checkpoint.done:
+            # done before the run was interrupted
+            return (position, d, None)
+        if verbose > 1:
+            print ("PoS: ", json.dumps (d, indent=2), file=sys.stderr)
+        base = mapBase (d)
+        ventures = []
+        for t in targets:
+            c = mapTarget (base, d, t.user_id, t.trl_attr_name)
+            ventures.append ((c, payloadHash (c)))
+        return (position, d, ventures)
+
+    def diffStage (item):
+        # the only stage touching name2id
+        position, d, ventures = item
+        writes = []
+        for i, t in enumerate (targets):
+            idCMINE = None
+            if d["title"] in t.name2id:
+                idCMINE = t.name2id[d["title"]]["id"]
+                t.name2id[d["title"]]["still_exists"] = True
+            if ventures is None:
+                continue
+            c, h = ventures[i]
+            # Did the content we send change? Timestamps would miss some
+            # edits and trigger writes when PoS only touched the record.
+            # Unknown hash: write once to learn it.
+            if idCMINE is not None and t.index.payloadHash (idCMINE) == h:
+                count ("unchanged")
+                continue
+            writes.append ((i, idCMINE, c, h))
+        if ventures is None:
+            count ("resumed")
+        if not writes:
+            if checkpoint is not None:
+                checkpoint.commit (position, d["title"])
+            return None
+        return (position, d["title"], writes, d.get ("id"))
+
+    def write (position, title, target, idCMINE, c, h, pos_key):
+        # counted only when CMINE confirmed the write
+        count (writeVenture (target.url, target.token, idCMINE, c, target.index, h, pos_key))
+        with runningLock:
+            running[position] -= 1
+            done = running[position] == 0
+            if done:
+                del running[position]
+        # done with all targets
+        if done and checkpoint is not None:
+            checkpoint.commit (position, title)
+
+    def writeStage (item):
+        position, title, writes, pos_key = item
+        with runningLock:
+            running[position] = len (writes)
+        for i, idCMINE, c, h in writes:
+            writers[i].submit (label (targets[i], title), write, position, title, targets[i], idCMINE, c, h, pos_key)
+
+    try:
+        pipeline (enumerate (solutions, offset), [mapStage, diffStage], writeStage, queue_size)
+    finally:
+        errors = []
+        for w in writers:
+            errors += w.join ()
+    for t in targets:
+        if t.duplicates:
+            deletes = deleteVentures (t.url, t.token, t.duplicates, workers, t.index, checkpoint, t.name)
+            errors += [(label (t, name), e) for name, e in deletes]
+    return errors
+
+
+def writeVenture (url, token, venture_id, c, index, h, pos_key):
+    """Write one venture to CMINE and remember what was written in the index
+
+    Returns "created" or "updated".
+    """
+    try:
+        v = writeToCmine (url, token, venture_id, c)
+    except CmineNotFound as e:
+        # Deleted behind our back: the index is not to be trusted any more
+        print ("{}, creating it again".format (e), file=sys.stderr)
+        index.remove (venture_id)
+        index.invalidate ()
+        venture_id = None
+        v = writeToCmine (url, token, None, c)
+    if v.get ("id") is not None:
+        index.store (v["id"], c["venture"]["high_level_pitch"], v.get ("updated_at"), pos_key, h)
+    return "updated" if venture_id is not None else "created"
+
+
+def syncPass (args, posUrl, targets, state, checkpoint, resumed=False, stop=None):
+    """One sync of PoS (or a snapshot) to the CMINE targets
+
+    Full or, with --incremental / --watch, incremental. A resumed
+    checkpoint continues an interrupted run. Setting stop ends the pass
+    after the writes in progress, keeping the checkpoint for --resume.
+    The state is saved. Returns "done", "failed" or "stopped".
+    """
+    if resumed:
+        syncStart = iso8601.parse_date (checkpoint.run["started"])
+        fullSync = checkpoint.run["full"]
+        changed = None
+        snapshot = checkpoint.run.get ("snapshot")
+        if not fullSync:
+            # PoS evaluates the relative filter at request time: cover the
+            # same changes as the interrupted run, but as the result set is
+            # a different one, its offset means nothing; skip by done titles
+            changed = posChangedSince (iso8601.parse_date (checkpoint.run["since"]), datetime.datetime.now (tz.tzutc ()))
+            checkpoint.rewind ()
+        print ("Resuming sync started {} at PoS offset {} ({} solutions done, {} deletes pending)".format (
+            checkpoint.run["started"], checkpoint.offset, len (checkpoint.done), len (checkpoint.deletes)), file=sys.stderr)
+        for target in targets:
+            for name, e in deleteVentures (target.url, target.token, checkpoint.pending (target.name), args.workers, target.index, checkpoint, target.name):
+                print ("  {}: {}".format (name, e), file=sys.stderr)
+    else:
+        syncStart = datetime.datetime.now (tz.tzutc ())
+        fullSync = True
+        changed = None
+        since = None
+        snapshot = args.snapshot
+        # a snapshot always has all solutions
+        if (args.incremental or args.watch) and not snapshot and "last_sync" in state and "last_full_sync" in state:
+            lastFull = iso8601.parse_date (state["last_full_sync"])
+            if syncStart - lastFull < datetime.timedelta (days=args.full_sync_days):
+                fullSync = False
+                since = state["last_sync"]
+                changed = posChangedSince (iso8601.parse_date (since), syncStart)
+        checkpoint.start ({"mode": "sync", "started": syncStart.isoformat (), "full": fullSync, "since": since, "snapshot": snapshot})
+    if verbose:
+        if snapshot:
+            print ("Full sync from snapshot {}".format (snapshot), file=sys.stderr)
+        else:
+            print ("Full sync" if fullSync else "Incremental sync, PoS changed {}".format (changed), file=sys.stderr)
+
+    # name2id is reloaded from the (warm) index, it does not know our last writes
+    for target in targets:
+        target.reset ()
+    summary = collections.Counter ({k: 0 for k in ["created", "updated", "unchanged", "deleted", "failed"]})
+    if snapshot:
+        solutions = readSnapshot (snapshot, checkpoint.offset)
+    else:
+        solutions = posGenerator(posUrl, args.pos_prefetch, args.pos_parallel, changed, checkpoint.offset)
+    if args.one:
+        solutions = itertools.islice (solutions, 1)
+    stopped = []
+
+    def untilStopped (solutions):
+        for d in solutions:
+            if stop is not None and stop.is_set ():
+                stopped.append (True)
+                return
+            yield d
+
+    errors = syncToCmine (untilStopped (solutions), targets, args.workers, summary, args.queue_size, checkpoint)
+    for target in targets:
+        for name in checkpoint.done:
+            if target.name2id and name in target.name2id:
+                target.name2id[name]["still_exists"] = True
+    if errors:
+        print ("{} solutions could not be written to CMINE:".format (len (errors)), file=sys.stderr)
+        for name, e in errors:
+            print ("  {}: {}".format (name, e), file=sys.stderr)
+    summary["failed"] = len (errors)
+    print ("Summary: {} created, {} updated, {} unchanged (writes avoided), {} failed".format (
+        summary["created"], summary["updated"], summary["unchanged"], len (errors)), file=sys.stderr)
+    # ventures_total: the rest is counted by syncToCmine / deleteVentures
+    for k in ["created", "updated", "unchanged", "deleted"]:
+        metrics.count (k, 0)
+    metrics.count ("failed", len (errors))
+    if stopped:
+        # like an interrupted run: keep the checkpoint and the old high-water mark
+        print ("Stopped at PoS offset {}, continue with --resume".format (checkpoint.offset), file=sys.stderr)
+        saveState (args.state_file, state)
+        return "stopped"
+    if args.one:
+        saveState (args.state_file, state)
+        if not errors:
+            checkpoint.finish ()
+        return "failed" if errors else "done"
+
+    # Only a full sync has seen all PoS solutions. PoS may have changed
+    # while a resumed run was interrupted, so it might have missed some.
+    # Never delete after failed writes, the solution might just be missing.
+    if fullSync and not resumed and not errors:
+        for target in targets:
+            orphans = [(d["id"], n) for n, d in (target.name2id or {}).items() if not d["still_exists"]]
+            if args.delete_orphans:
+                deletes = deleteVentures (target.url, target.token, orphans, args.workers, target.index, checkpoint, target.name)
+                for name, e in deletes:
+                    print ("  {}: {}".format (name, e), file=sys.stderr)
+                errors += deletes
+            else:
+                for venture_id, n in orphans:
+                    print ("delete {} (use --delete-orphans)".format (n), file=sys.stderr)
+    if errors:
+        # keep the old high-water mark so failed solutions are tried again;
+        # keep the checkpoint so --resume only retries what is missing
+        saveState (args.state_file, state)
+        return "failed"
+    if not resumed and not snapshot:
+        # see above: the next regular run catches up on a resumed one;
+        # PoS may have changed after the snapshot was taken
+        state["last_sync"] = syncStart.isoformat ()
+        if fullSync:
+            state["last_full_sync"] = syncStart.isoformat ()
+    saveState (args.state_file, state)
+    checkpoint.finish ()
+    return "done"
+
+
 if __name__ == '__main__':
     load_dotenv()
     parser = argparse.ArgumentParser(description='Sync Pos to CMINE')
@@ -386,92 +1833,177 @@ if __name__ == '__main__':
     parser.add_argument('--cmine-owner', help='CMINE solution ownners eamil', default=os.getenv ("cmine_owner"))
     parser.add_argument('--cmine-client-id', help='CMINE client UID', default=os.getenv ("cmine_client_id"))
     parser.add_argument('--cmine-client-secret', help='CMINE client secret', default=os.getenv ("cmine_client_secret"))
+    parser.add_argument('--targets', help='JSON file listing several CMINE instances to write to (see README)', default=os.getenv ("targets"))
+
+    parser.add_argument('--token-cache', help='File to keep the CMINE oauth token between runs', default=os.getenv ("token_cache"))
+    parser.add_argument('--retries', help='Number of retries for failed HTTP requests', type=int, default=int (os.getenv ("retries", 4)))
+    parser.add_argument('--max-rate', help='Upper limit of requests per second to each host (default: as fast as the server allows)', type=float, default=float (os.getenv ("max_rate")) if os.getenv ("max_rate") else None)
+    parser.add_argument('--pool-size', help='HTTP connections kept per host', type=int, default=int (os.getenv ("pool_size", 10)))
+    parser.add_argument('--connect-timeout', help='HTTP connect timeout in seconds', type=float, default=float (os.getenv ("connect_timeout", 10)))
+    parser.add_argument('--read-timeout', help='HTTP read timeout in seconds', type=float, default=float (os.getenv ("read_timeout", 60)))
+
+    parser.add_argument('--pos-prefetch', help='Number of PoS pages read ahead while solutions are written', type=int, default=int (os.getenv ("pos_prefetch", 0)))
+    parser.add_argument('--pos-parallel', help='Number of PoS pages fetched in parallel', type=int, default=int (os.getenv ("pos_parallel", 0)))
+    parser.add_argument('--cmine-parallel', help='Number of CMINE venture list pages fetched in parallel', type=int, default=int (os.getenv ("cmine_parallel", 4)))
+    parser.add_argument('--cmine-per-page', help='Ventures per CMINE list page (the server may use less)', type=int, default=int (os.getenv ("cmine_per_page", 100)))
+    parser.add_argument('--incremental', help='Only sync solutions changed in PoS since the last successful sync', action="store_true")
+    parser.add_argument('--watch', help='Keep running: sync changed solutions every --watch-interval minutes, stop on SIGTERM', action="store_true")
+    parser.add_argument('--watch-interval', help='Minutes between the syncs of --watch', type=float, default=float (os.getenv ("watch_interval", 15)))
+    parser.add_argument('--full-sync-days', help='With --incremental: do a full sync (including delete pass) after this many days; the venture index is checked against CMINE as often', type=float, default=float (os.getenv ("full_sync_days", 7)))
+    parser.add_argument('--state-file', help='File keeping the sync state', default=os.getenv ("state_file", "pos2cmine.state.json"))
+    parser.add_argument('--index-file', help='SQLite file keeping the index of our CMINE ventures', default=os.getenv ("index_file", "pos2cmine.db"))
+    parser.add_argument('--rebuild-index', help='Rebuild the venture index from a full CMINE listing (and forget cached owner id, TRL attribute name)', action="store_true")
+    parser.add_argument('--metadata-ttl', help='Hours the CMINE owner id and TRL attribute name are cached in the index (0: not cached)', type=float, default=float (os.getenv ("metadata_ttl", 24)))
+    parser.add_argument('--checkpoint', help='Journal of the running sync, used by --resume', default=os.getenv ("checkpoint", "pos2cmine.checkpoint"))
+    parser.add_argument('--resume', help='Continue an interrupted sync from its checkpoint', action="store_true")
+    parser.add_argument('--workers', help='Number of concurrent CMINE writes', type=int, default=int (os.getenv ("workers", 1)))
+    parser.add_argument('--queue-size', help='Number of solutions queued between the sync stages', type=int, default=int (os.getenv ("queue_size", 100)))
+
+    parser.add_argument('--metrics-json', help='Write run metrics as JSON to this file', default=os.getenv ("metrics_json"))
+    parser.add_argument('--metrics-prom', help='Write run metrics as Prometheus textfile (e.g. for node_exporter) to this file', default=os.getenv ("metrics_prom"))
 
     parser.add_argument('--verbose', '-v', help='Be verbose (can be used multiple times)', action="count")
 
     parser.add_argument('--test', '-t', help='Test something instead of doing useful work', choices=["PoS", "me", "users", "ventures", "custom"])
+    parser.add_argument('--snapshot', help='PoS snapshot (one solution per line, .gz compressed): written by --test PoS (default: stdout), read instead of PoS by a sync')
+    parser.add_argument('--diff', help='Show the differences of two PoS snapshots', nargs=2, metavar=("OLD", "NEW"))
     parser.add_argument ('--one', help="Copy only one solution", action="store_true")
     parser.add_argument ('--delete', help="Delete ALL my solutions", action="store_true")
+    parser.add_argument ('--delete-orphans', help="On a full sync delete ventures no longer in PoS", action="store_true",
+                         default=os.getenv ("delete_orphans", "").lower () in ("1", "true", "yes"))
 
     args = parser.parse_args()
 
     if args.verbose:
         verbose = args.verbose
-    for a in ['pos_url', 'cmine_url', 'cmine_email', 'cmine_password', 'cmine_owner', 'cmine_client_id', 'cmine_client_secret']:
-        if not getattr (args, a):
-            print ("Provide argument '--{}' or enviroment variable '{}'!".format (a.replace('_', '-'), a), file=sys.stderr)
-            exit (1)
+    if args.diff:
+        changes = collections.Counter ()
+        for change, title in diffSnapshots (*args.diff):
+            print (change, title)
+            changes[change] += 1
+        print ("Summary: {} new, {} changed, {} removed".format (changes["+"], changes["~"], changes["-"]), file=sys.stderr)
+        exit (0)
+    try:
+        targetSettings = loadTargets (args.targets, vars (args))
+    except Exception as e:
+        print ("Could not read CMINE targets: {}".format (e), file=sys.stderr)
+        exit (1)
+    if not args.pos_url:
+        print ("Provide argument '--pos-url' or enviroment variable 'pos_url'!", file=sys.stderr)
+        exit (1)
+    for t in targetSettings:
+        for a in ['cmine_url', 'cmine_email', 'cmine_password', 'cmine_owner', 'cmine_client_id', 'cmine_client_secret']:
+            if not t[a]:
+                if args.targets:
+                    print ("Provide '{}' for CMINE target '{}' in {}!".format (a, t["name"], args.targets), file=sys.stderr)
+                else:
+                    print ("Provide argument '--{}' or enviroment variable '{}'!".format (a.replace('_', '-'), a), file=sys.stderr)
+                exit (1)
     posUrl = args.pos_url
-    cmineUrl = args.cmine_url
+    # also written if the run fails
+    atexit.register (metrics.write, args.metrics_json, args.metrics_prom)
+    client = HttpClient (max (args.pool_size, args.workers, args.pos_parallel, args.cmine_parallel), args.connect_timeout, args.read_timeout,
+                         hosts=max (4, len (targetSettings) + 1), retries=args.retries, max_rate=args.max_rate)
+
+    if args.test == "PoS":
+        n = writeSnapshot (posGenerator(posUrl, args.pos_prefetch, args.pos_parallel), args.snapshot or "-")
+        if verbose:
+            print ("{} solutions written".format (n), file=sys.stderr)
+        exit (0)
+
+    targets = []
+    for t in targetSettings:
+        tokens = TokenManager (t["cmine_url"], t["cmine_email"], t["cmine_password"], t["cmine_client_id"], t["cmine_client_secret"], t["token_cache"])
+        targets.append (CmineTarget (t["cmine_url"], tokens, t["cmine_owner"], None, args.cmine_parallel, args.cmine_per_page, t["name"], args.metadata_ttl * 3600, args.full_sync_days * 86400))
 
     if args.test:
-        if "PoS" == args.test:
-            print (json.dumps ([d for d in posGenerator(posUrl)]))
-            exit (0)
-        token = getAuthToken(cmineUrl, args.cmine_email, args.cmine_password, args.cmine_client_id, args.cmine_client_secret)
-        if "me" == args.test:
-            getMyUserId (cmineUrl, token)
-        if "users" == args.test:
-            getUserId (cmineUrl, token, args.cmine_owner)
-        if "ventures" == args.test:
-            print ("Ventures by name: ", getVentures (cmineUrl, token), file=sys.stderr)
-        if "custom" == args.test:
-            print ("Custom TRL attributes: ", getCustomAttributes (cmineUrl, token, "(Trl)"), file=sys.stderr)
+        for target in targets:
+            cmineUrl = target.url
+            token = target.token
+            if target.name is not None:
+                print ("CMINE target {}:".format (target.name), file=sys.stderr)
+            if "me" == args.test:
+                getMyUserId (cmineUrl, token)
+            if "users" == args.test:
+                print ("Owner id: ", getUserId (cmineUrl, token, target.owner, args.cmine_per_page), file=sys.stderr)
+            if "ventures" == args.test:
+                duplicates = []
+                print ("Ventures by name: ", getVentures (cmineUrl, token, None, duplicates, args.cmine_parallel, args.cmine_per_page), file=sys.stderr)
+                print ("Duplicates (id, name): ", duplicates, file=sys.stderr)
+            if "custom" == args.test:
+                print ("Custom TRL attributes: ", getCustomAttributes (cmineUrl, token, "(Trl)"), file=sys.stderr)
         exit(0)
 
+    for t, target in zip (targetSettings, targets):
+        target.index = VentureIndex (t["index_file"])
+        if args.rebuild_index:
+            target.index.invalidate ()
+            target.index.clearCache ()
+
     if args.delete:
-        token = getAuthToken(cmineUrl, args.cmine_email, args.cmine_password, args.cmine_client_id, args.cmine_client_secret)
-        user_id = getUserId (cmineUrl, token, args.cmine_owner)
-        myName2id = getVentures(cmineUrl, token, user_id)
-        for name, d in myName2id.items():
-            print ("! CMINE: delete '{}'".format(name))
-            deleteVenture(cmineUrl, token, d["id"])
+        checkpoint = Checkpoint (args.checkpoint)
+        if args.resume and checkpoint.load () and checkpoint.run.get ("mode") != "delete":
+            print ("Checkpoint {} is not from --delete".format (args.checkpoint), file=sys.stderr)
+            exit (1)
+        if checkpoint.run is None:
+            checkpoint.start ({"mode": "delete", "started": datetime.datetime.now (tz.tzutc ()).isoformat ()})
+            for target in targets:
+                user_id = getUserId (target.url, target.token, target.owner, args.cmine_per_page)
+                duplicates = []
+                myName2id = getVentures(target.url, target.token, user_id, duplicates, args.cmine_parallel, args.cmine_per_page)
+                target.index.rebuild (myName2id)
+                for name, d in myName2id.items():
+                    checkpoint.delete (d["id"], name, target.name)
+                # ALL my solutions: also the duplicates
+                for venture_id, name in duplicates:
+                    checkpoint.delete (venture_id, name, target.name)
+        errors = []
+        for target in targets:
+            deletes = checkpoint.pending (target.name)
             if args.one:
-                exit(0)
+                deletes = deletes[:1]
+            errors += deleteVentures (target.url, target.token, deletes, args.workers, target.index, checkpoint, target.name)
+        for name, e in errors:
+            print ("  {}: {}".format (name, e), file=sys.stderr)
+        print ("Summary: {} deleted, {} failed".format (metrics.counters["deleted"], len (errors)), file=sys.stderr)
+        if errors or args.one:
+            exit (1 if errors else 0)
+        checkpoint.finish ()
         exit(0)
 
-    token = None
-    user_id = None
-    name2id = {}
-    for d in posGenerator(posUrl):
-        if verbose > 2:
-            print (d, file=sys.stderr)
-        if token is None:
-            token = getAuthToken(cmineUrl, args.cmine_email, args.cmine_password, args.cmine_client_id, args.cmine_client_secret)
-            user_id = getUserId (cmineUrl, token, args.cmine_owner)
-            name2id = getVentures(cmineUrl, token, user_id)
-            if verbose:
-                print ("Available on CMINE: ", name2id.keys(), file=sys.stderr)
-            trl_attr_names = getCustomAttributes (cmineUrl, token, "(Trl)")
-            if len (trl_attr_names) == 1:
-                trl_attr_name = trl_attr_names[0]
-            else:
-                trl_attr_name = None
-                print ("Could not identify TRL custom attribute. Candidates are ", trl_attr_names)
-            # testAccessToken (cmineUrl, token)
+    state = loadState (args.state_file)
+    checkpoint = Checkpoint (args.checkpoint)
+    resumed = args.resume and checkpoint.load ()
+    if resumed and checkpoint.run.get ("mode") != "sync":
+        print ("Checkpoint {} is not from a sync, use --delete --resume".format (args.checkpoint), file=sys.stderr)
+        exit (1)
+    if args.watch and (args.snapshot or args.one):
+        print ("--watch can not be used with --snapshot or --one", file=sys.stderr)
+        exit (1)
+
+    stop = threading.Event ()
+
+    def shutdown (signum, frame):
+        print ("Got signal {}, stopping after the writes in progress".format (signum), file=sys.stderr)
+        stop.set ()
 
-        # prepare CMINE update
-        idCMINE = None
-        needUpdate = True
-        if d["title"] in name2id:
-            idCMINE = name2id[d["title"]]["id"]
-            # Is PoS newer than CMINE?
-            # CMINE: "updated_at": "2019-09-04T12:08:09Z",
-            tCMINE = iso8601.parse_date(name2id[d["title"]]["updated_at"]).astimezone(tz.tzutc()).replace (tzinfo=None)
-            # PoS: "changed": "2019-09-10T17:07:26+0200"
-            tPoS = iso8601.parse_date(d["changed"]).astimezone(tz.tzutc()).replace (tzinfo=None)
-            # print ("tCMINE: ", tCMINE, file=sys.stderr)
-            # print ("tPoS:   ", tPoS, file=sys.stderr)
-            needUpdate = tPoS > tCMINE
-        if needUpdate:
-            writeToCmine (cmineUrl, token, user_id, idCMINE, trl_attr_name, d, posUrl)
-        if d["title"] in name2id:
-            name2id[d["title"]]["still_exists"] = True
-        if args.one:
-            exit (0)
-
-    # TODO: use names2id.still_exists=False
-    for n, d in name2id.items():
-        if not d["still_exists"]:
-            print ("delete {}".format (n), file=sys.stderr)
-            # deleteVenture(cmineUrl, token, d["id"])
+    signal.signal (signal.SIGTERM, shutdown)
+    if args.watch:
+        signal.signal (signal.SIGINT, shutdown)
+    while True:
+        try:
+            result = syncPass (args, posUrl, targets, state, checkpoint, resumed, stop)
+        except Exception as e:
+            if not args.watch:
+                raise
+            # CMINE or PoS down: try again next time
+            print ("Sync failed: {}".format (e), file=sys.stderr)
+            result = "failed"
+        if not args.watch or stop.is_set ():
+            break
+        metrics.write (args.metrics_json, args.metrics_prom)
+        if stop.wait (args.watch_interval * 60):
+            break
+        checkpoint = Checkpoint (args.checkpoint)
+        resumed = False
+    exit (0 if result == "done" or (args.watch and result == "stopped") else 1)